@@ -1,18 +1,18 @@
 #!/usr/bin/env python3
 
 import os.path
+import shutil
 
 import time
 from datetime import timedelta
 import logging
 import argparse
-import requests
-from requests.adapters import HTTPAdapter, Retry
-import xml.etree.ElementTree
-import copy
-import threading
+import httpx
+from lxml import etree
+import concurrent.futures
 import math
 import re
+import urllib.parse
 
 from termcolor import colored
 
@@ -22,6 +22,22 @@ logger = logging.getLogger('dash-proxy')
 
 ns = {'mpd':'urn:mpeg:dash:schema:mpd:2011'}
 
+# Clark-form tags, so lookups don't have to resolve the 'mpd:' prefix every time
+TAG_PERIOD = '{urn:mpeg:dash:schema:mpd:2011}Period'
+TAG_AS = '{urn:mpeg:dash:schema:mpd:2011}AdaptationSet'
+TAG_REP = '{urn:mpeg:dash:schema:mpd:2011}Representation'
+TAG_ST = '{urn:mpeg:dash:schema:mpd:2011}SegmentTemplate'
+TAG_STL = '{urn:mpeg:dash:schema:mpd:2011}SegmentTimeline'
+TAG_S = '{urn:mpeg:dash:schema:mpd:2011}S'
+TAG_EP = '{urn:mpeg:dash:schema:mpd:2011}EssentialProperty'
+TAG_LOC = '{urn:mpeg:dash:schema:mpd:2011}Location'
+TAG_BU = '{urn:mpeg:dash:schema:mpd:2011}BaseURL'
+
+COPY_BUFFER_SIZE = 1 << 20
+MPD_CHUNK_SIZE = 1 << 16
+
+_NUMBER_FMT_RE = re.compile(r'\$Number%([0-9]*)d\$')
+
 
 class Formatter(logging.Formatter):
     def __init__(self, fmt=None, datefmt=None):
@@ -48,38 +64,81 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 def baseUrl(url):
-    # remove query first - parameters can contain '/' too
-    idx = url.rfind('?')
-    if idx >= 0:
-        url = url[:idx]
+    # drops the query (which can contain '/' too) and the last path segment
+    return urllib.parse.urljoin(url, '.')
 
-    idx = url.rfind('/')
-    if idx >= 0:
-        return url[:idx+1]
-    else:
-        return url
+# designator -> seconds, in the order they may appear
+_DURATION_DATE_UNITS = (('D', 24 * 60 * 60),)
+_DURATION_TIME_UNITS = (('H', 60 * 60), ('M', 60), ('S', 1))
 
 def ISO8601DurationSeconds(duration: str) -> float:
-    a_float = '([0-9]+(\.[0-9]+)?)'
-    maybe = lambda suffix: f'({a_float}{suffix})?'
+    # Hand-rolled scanner for P[nD][T[nH][nM][nS]], called for every Period and refresh so skip the regex machinery.
     # reject [Y]ears and [M]onths because their time varies (also assume no leap seconds)
-    pattern = f'P{maybe("D")}T{maybe("H")}{maybe("M")}{maybe("S")}'
-    match = re.match(pattern, duration)
-    if not match:
+    if not duration.startswith('P'):
+        raise RuntimeError(f'Invalid duration: {duration}')
+    s = 0.0
+    units = _DURATION_DATE_UNITS
+    time_part = False
+    number_start = 1
+    for i in range(1, len(duration)):
+        c = duration[i]
+        if c.isdigit() or c == '.':
+            continue
+        if c == 'T' and not time_part and number_start == i:
+            time_part = True
+            units = _DURATION_TIME_UNITS
+            number_start = i + 1
+            continue
+        for unit_idx, (unit, multiplier) in enumerate(units):
+            if unit == c:
+                break
+        else:
+            raise RuntimeError(f'Invalid duration: {duration}')
+        try:
+            s += multiplier * float(duration[number_start:i])
+        except ValueError:
+            raise RuntimeError(f'Invalid duration: {duration}') from None
+        # designators can only appear in order and once
+        units = units[unit_idx + 1:]
+        number_start = i + 1
+    # must end with a designator: at least one component is required and a 'T' must be followed by one
+    if number_start != len(duration) or duration[-1] in 'PT':
         raise RuntimeError(f'Invalid duration: {duration}')
-    (d, h, m, s) = match.group(2,5,8,11)
-    s = float(s or '0')
-    s += 60 * float(m or '0')
-    s += 60 * 60 * float(h or '0')
-    s += 24 * 60 * 60 * float(d or '0')
     return s
 
+def escape_format(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+def expand_segment_timeline(segments):
+    # Expands (t, d, r) of <S t="..." d="..." r="..."> (t=-1 when absent) into a list of (t, d) of every segment,
+    # also returns the sum of their durations.
+    expanded = []
+    total = 0
+    next_time = 0
+    for current_time, duration, repeat in segments:
+        if current_time != -1:
+            next_time = current_time
+        count = max(repeat, 0) + 1
+        expanded.extend((next_time + i * duration, duration) for i in range(count))
+        next_time += count * duration
+        total += count * duration
+    return expanded, total
+
 class RepAddr(object):
     def __init__(self, period_idx, adaptation_set_idx, representation_idx):
         self.period_idx = period_idx
         self.adaptation_set_idx = adaptation_set_idx
         self.representation_idx = representation_idx
 
+    def __eq__(self, other):
+        return isinstance(other, RepAddr) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def key(self):
+        return (self.period_idx, self.adaptation_set_idx, self.representation_idx)
+
     def __str__(self):
         return 'Representation (period=%d adaptation-set=%d representation=%d)' % (self.period_idx, self.adaptation_set_idx, self.representation_idx)
 
@@ -87,78 +146,75 @@ class RepAddr(object):
 class MpdLocator(object):
     def __init__(self, mpd):
         self.mpd = mpd
-
-    def representation(self, rep_addr):
-        return self.adaptation_set(rep_addr).findall('mpd:Representation', ns)[rep_addr.representation_idx]
-
-    def segment_template(self, rep_addr):
-        rep_st = self.representation(rep_addr).find('mpd:SegmentTemplate', ns)
-        if rep_st is not None:
-            return rep_st
-        else:
-            return self.adaptation_set(rep_addr).find('mpd:SegmentTemplate', ns)
-
-    def segment_timeline(self, rep_addr):
-        return self.segment_template(rep_addr).find('mpd:SegmentTimeline', ns)
-
-    def adaptation_set(self, rep_addr):
-        return self.period(rep_addr).findall('mpd:AdaptationSet', ns)[rep_addr.adaptation_set_idx]
+        self._periods = None
+        self._period_starts = None
 
     def periods(self):
-        return self.mpd.findall('mpd:Period', ns)
+        # period_start()/period_end() walk the periods over and over, look them up once
+        if self._periods is None:
+            self._periods = list(self.mpd.iterchildren(TAG_PERIOD))
+        return self._periods
 
     def period(self, rep_addr):
         return self.periods()[rep_addr.period_idx]
 
     def period_start(self, rep_addr):
-        start = 0.0
-        # 3.10.2.2.3. Period Information
-        period = self.period(rep_addr)
-        if 'start' in period.attrib:
-            # - If the attribute @start is present in the Period, then PSwc[i] is the value of this attribute
-            #   minus the value of @start of the first Period.
-            if rep_addr.period_idx != 0:
-                start = ISO8601DurationSeconds(period.attrib.get('start'))
-                first_start = self.period_start(RepAddr(0, 0, 0))
-                start -= first_start
-            else:
-                # The above quote implies that PSwc[i] is relative to @start of 1st Period
-                # so for i=0 it will always be 0.0 _by definition_ (@start - @start == 0).
-                start = 0.0
-        else:
-            previous_rep_addr = RepAddr(rep_addr.period_idx - 1) if rep_addr.period_idx != 0 else None
-            previous_period = self.period(previous_rep_addr) if previous_rep_addr else None
-            # - If the @start attribute is absent, but the previous Period element contains a @duration attribute ...
-            if previous_period and 'duration' in previous_duration.attrib:
-                previous_duration = ISO8601DurationSeconds(previous_duration.attrib.get('duration'))
-                previous_start = self.period_start(previous_rep_addr)
-                # ... then the start time of the Period is the sum of the start time of the previous
-                # Period PSwc[i] and the value of the attribute @duration of the previous Period.
-                start = previous_start + previous_duration
-            else:
-                # And if there is neither @start nor previous @duration then what? Malformed MPD?
-                pass
-        return start
+        return self.period_starts()[rep_addr.period_idx]
 
     def period_end(self, rep_addr):
-        end = 0.0
-        period_count = len(self.periods())
+        return self._period_end(rep_addr.period_idx)
+
+    def period_starts(self):
+        # PSwc[i] only depends on PSwc[i-1], so compute all of them in a single forward pass
+        # instead of recursing (and re-parsing the durations) for every lookup.
+        if self._period_starts is None:
+            self._period_starts = []
+            first_start = 0.0
+            previous_period = None
+            for idx, period in enumerate(self.periods()):
+                start = 0.0
+                # 3.10.2.2.3. Period Information
+                if 'start' in period.attrib:
+                    # - If the attribute @start is present in the Period, then PSwc[i] is the value of this attribute
+                    #   minus the value of @start of the first Period.
+                    if idx != 0:
+                        start = ISO8601DurationSeconds(period.attrib.get('start')) - first_start
+                    else:
+                        # The above quote implies that PSwc[i] is relative to @start of 1st Period
+                        # so for i=0 it will always be 0.0 _by definition_ (@start - @start == 0).
+                        first_start = ISO8601DurationSeconds(period.attrib.get('start'))
+                        start = 0.0
+                elif previous_period is not None and 'duration' in previous_period.attrib:
+                    # - If the @start attribute is absent, but the previous Period element contains a @duration attribute
+                    #   then the start time of the Period is the sum of the start time of the previous
+                    #   Period PSwc[i] and the value of the attribute @duration of the previous Period.
+                    start = self._period_starts[idx - 1] + ISO8601DurationSeconds(previous_period.attrib.get('duration'))
+                else:
+                    # And if there is neither @start nor previous @duration then what? Malformed MPD?
+                    pass
+                self._period_starts.append(start)
+                previous_period = period
+        return self._period_starts
+
+    def _period_end(self, period_idx):
+        starts = self.period_starts()
         # 3.10.2.2.3. Period Information
         # If the Period is the last one in the MPD, the time PEwc[i] is obtained as
-        if rep_addr.period_idx == period_count - 1:
+        if period_idx == len(starts) - 1:
             if 'mediaPresentationDuration' in self.mpd.attrib:
                 # the Media Presentation Duration MPDur, with MPDur the value of MPD@mediaPresentationDuration if present
-                end = ISO8601DurationSeconds(self.mpd.attrib.get('mediaPresentationDuration'))
+                return ISO8601DurationSeconds(self.mpd.attrib.get('mediaPresentationDuration'))
             else:
                 # or the sum of PSwc[i] of the last Period and the value of Period@duration of the last Period.
-                period = self.period(rep_addr)
-                start = self.period_start(rep_addr)
-                duration = ISO8601DurationSeconds(period.attrib.get('duration')) # implicitly required to be present
-                end = start + duration
+                period = self.periods()[period_idx]
+                if 'duration' not in period.attrib:
+                    # e.g. a dynamic MPD whose last Period is still open
+                    raise RuntimeError('Cannot determine the end of the last Period: neither Period@duration nor MPD@mediaPresentationDuration is present')
+                duration = ISO8601DurationSeconds(period.attrib.get('duration'))
+                return starts[period_idx] + duration
         else:
             # the time PEwc[i] is obtained as the Period start time of the next Period, i.e. PEwc[i] = PSwc[i+1].
-            end = self.period_start(RepAddr(rep_addr.period_idx + 1))
-        return end
+            return starts[period_idx + 1]
 
 class HasLogger(object):
     def verbose(self, msg):
@@ -178,6 +234,11 @@ class HasLogger(object):
 
 class DashProxy(HasLogger):
     retry_interval = 10
+    default_refresh_interval = 10
+    max_retry_interval = 300
+    max_attempts = 10
+    min_refresh_interval = 1
+    download_workers = 16
 
     def __init__(self, mpd, output_dir, download, save_mpds=False, bandwidth_limit=0):
         self.logger = logger
@@ -191,136 +252,195 @@ class DashProxy(HasLogger):
 
         self.downloaders = {}
 
+        # one pooled client for the MPD and all the segments - they usually come from the same host,
+        # so with HTTP/2 the concurrent segment requests get multiplexed over a single connection
+        limits = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        transport = httpx.HTTPTransport(http2=True, limits=limits, retries=3)
+        self.client = httpx.Client(transport=transport, timeout=30.0, follow_redirects=True)
+
+        # segment downloads of all the representations share a bounded pool of workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.download_workers)
+
     def run(self):
         logger.log(logging.INFO, 'Running dash proxy for stream %s. Output goes in %s' % (self.mpd, self.output_dir))
-        self.refresh_mpd()
-
-    def refresh_mpd(self, after=0, error_cnt=0):
+        while True:
+            next_refresh = self.refresh_mpd()
+            if next_refresh is None:
+                break
+            time.sleep(next_refresh)
+
+    # Returns the number of seconds until the next refresh or None when there is nothing more to refresh
+    def refresh_mpd(self):
         self.i_refresh += 1
-        if after>0:
-            time.sleep(after)
-
-        r = requests.get(self.mpd)
-        if r.status_code < 200 or r.status_code >= 300:
-            error_cnt += 1
-            logger.log(logging.WARNING, 'Cannot GET the MPD. Server returned %s. Retrying after %ds' % (r.status_code, self.retry_interval))
-            if error_cnt < 10:
-                self.refresh_mpd(after=self.retry_interval, error_cnt=error_cnt)
-            else:
-                logger.log(logging.WARNING, 'Tried %d times. Giving up.' % error_cnt)
+        fetched_at = time.monotonic()
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                status_code, mpd, content = self.fetch_mpd()
+                if status_code >= 200 and status_code < 300:
+                    break
+                reason = 'Server returned %s' % (status_code,)
+            except (httpx.TransportError, etree.XMLSyntaxError) as e:
+                # connection problems, timeouts and truncated bodies deserve another try as well
+                reason = '%s: %s' % (type(e).__name__, e)
+            if attempt == self.max_attempts:
+                logger.log(logging.WARNING, 'Cannot GET the MPD. %s. Tried %d times. Giving up.' % (reason, attempt))
+                return None
+            retry_after = min(self.retry_interval * 2 ** (attempt - 1), self.max_retry_interval)
+            logger.log(logging.WARNING, 'Cannot GET the MPD. %s. Retrying after %ds' % (reason, retry_after))
+            time.sleep(retry_after)
+            fetched_at = time.monotonic()
 
-        xml.etree.ElementTree.register_namespace('', ns['mpd'])
-        mpd = xml.etree.ElementTree.fromstring(r.text)
         # save original
-        content = xml.etree.ElementTree.tostring(mpd, encoding="utf-8").decode("utf-8")
         os.makedirs(self.output_dir, exist_ok=True)
-        with open(self.output_dir + '/manifest.mpd.orig', 'w') as f:
+        with open(self.output_dir + '/manifest.mpd.orig', 'wb') as f:
             f.write(content)
 
-        self.handle_mpd(mpd)
+        futures = self.handle_mpd(mpd, content)
+
+        minimum_update_period = mpd.attrib.get('minimumUpdatePeriod', '')
+        if minimum_update_period:
+            # MPD@minimumUpdatePeriod counts from when the MPD was fetched. Segments still being downloaded
+            # won't be queued again by the next refresh, so there is no need to wait for them.
+            try:
+                refresh_interval = ISO8601DurationSeconds(minimum_update_period)
+            except RuntimeError as e:
+                logger.log(logging.WARNING, '%s. Refreshing every %ds' % (e, self.default_refresh_interval))
+                refresh_interval = self.default_refresh_interval
+            elapsed = time.monotonic() - fetched_at
+            return max(refresh_interval - elapsed, self.min_refresh_interval)
+        else:
+            self.info('VOD MPD. Nothing more to do. Waiting for downloads to finish...')
+            concurrent.futures.wait(futures)
+            return None
+
+    def fetch_mpd(self):
+        # Parse the MPD while it is still being received, keeping the raw bytes around for the .orig copy
+        with self.client.stream('GET', self.mpd) as r:
+            if r.status_code < 200 or r.status_code >= 300:
+                return r.status_code, None, None
+            # the MPD is remote input: never expand entities (e.g. SYSTEM "file:///...") or fetch anything it refers to
+            parser = etree.XMLParser(resolve_entities=False, no_network=True)
+            chunks = []
+            for chunk in r.iter_bytes(MPD_CHUNK_SIZE):
+                parser.feed(chunk)
+                chunks.append(chunk)
+            return r.status_code, parser.close(), b''.join(chunks)
 
     def get_base_url(self, mpd):
         base_url = baseUrl(self.mpd)
-        location = mpd.find('mpd:Location', ns)
+        location = mpd.find(TAG_LOC)
         if location is not None:
             base_url = baseUrl(location.text)
-        baseUrlNode = mpd.find('mpd:BaseUrl', ns)
-        if baseUrlNode:
-            if baseUrlNode.text.startswith('http://') or baseUrlNode.text.startswith('https://'):
-                base_url = baseUrl(baseUrlNode.text)
-            else:
-                base_url = base_url + baseUrlNode.text
+        baseUrlNode = mpd.find(TAG_BU)
+        if baseUrlNode is not None and baseUrlNode.text:
+            # resolves both absolute and relative BaseURLs
+            base_url = baseUrl(urllib.parse.urljoin(base_url, baseUrlNode.text.strip()))
         return base_url
 
-    def handle_mpd(self, mpd):
-        original_mpd = copy.deepcopy(mpd)
-
-        periods = original_mpd.findall('mpd:Period', ns)
+    def handle_mpd(self, mpd, content):
+        locator = MpdLocator(mpd)
+        periods = locator.periods()
         logger.log(logging.INFO, 'mpd=%s' % (periods,))
         logger.log(logging.VERBOSE, 'Found %d periods choosing the 1st one' % (len(periods),))
         period = periods[0]
-        for as_idx, adaptation_set in enumerate( period.findall('mpd:AdaptationSet', ns) ):
-            ep = adaptation_set.find('mpd:EssentialProperty', ns)
+        base_url = self.get_base_url(mpd)
+        futures = []
+        trickmode_sets = []
+        for as_idx, adaptation_set in enumerate( period.iterchildren(TAG_AS) ):
+            ep = adaptation_set.find(TAG_EP)
             if ep is not None and ep.attrib.get('schemeIdUri') == 'http://dashif.org/guidelines/trickmode' and ep.attrib.get('value') == '1':
-                period.remove(adaptation_set)
+                # removed only once all the downloaders are done with the tree, the indices must not shift
+                trickmode_sets.append(adaptation_set)
             else:
-                max_rep_idx = 0
-                max_representation = None
-                
-                for rep_idx, representation in enumerate( adaptation_set.findall('mpd:Representation', ns) ):
-                    max_representation = representation
-                    max_rep_idx = rep_idx
-
-
-                    self.verbose('Found representation with id %s' % (max_representation.attrib.get('id', 'UKN'),))
-                    rep_addr = RepAddr(0, as_idx, max_rep_idx)
-                    #self.ensure_downloader(mpd, rep_addr)
-                    thread = threading.Thread(target=self.ensure_downloader, args=(mpd,rep_addr))
-                    thread.start()
-
-        self.write_output_mpd(original_mpd)
-
-        minimum_update_period = mpd.attrib.get('minimumUpdatePeriod', '')
-        if minimum_update_period:
-            # TODO parse minimum_update_period
-            self.refresh_mpd(after=10)
-        else:
-            self.info('VOD MPD. Nothing more to do. Waiting for downloads to finish...')
-
-    def ensure_downloader(self, mpd, rep_addr):
+                # resolve everything the downloaders need in this single walk over the tree
+                as_segment_template = adaptation_set.find(TAG_ST)
+                for rep_idx, representation in enumerate( adaptation_set.iterchildren(TAG_REP) ):
+                    self.verbose('Found representation with id %s' % (representation.attrib.get('id', 'UKN'),))
+                    rep_addr = RepAddr(0, as_idx, rep_idx)
+                    segment_template = representation.find(TAG_ST)
+                    if segment_template is None:
+                        segment_template = as_segment_template
+                    if segment_template is None:
+                        self.warning('No SegmentTemplate for %s. Skipping.' % (rep_addr,))
+                        continue
+                    segment_timeline = segment_template.find(TAG_STL)
+                    futures += self.ensure_downloader(locator, rep_addr, base_url, representation, segment_template, segment_timeline)
+
+        for adaptation_set in trickmode_sets:
+            period.remove(adaptation_set)
+        # the original bytes are still valid when there was nothing to remove
+        self.write_output_mpd(mpd, content if not trickmode_sets else None)
+        return futures
+
+    def ensure_downloader(self, locator, rep_addr, base_url, rep, segment_template, segment_timeline):
         if rep_addr in self.downloaders:
             self.verbose('A downloader for %s already started' % (rep_addr,))
+            downloader = self.downloaders[rep_addr]
         else:
             self.info('Starting a downloader for %s' % (rep_addr,))
             downloader = DashDownloader(self, rep_addr)
             self.downloaders[rep_addr] = downloader
-            downloader.handle_mpd(mpd, self.get_base_url(mpd))
-
-    def write_output_mpd(self, mpd):
+        try:
+            return downloader.handle_mpd(locator, base_url, rep, segment_template, segment_timeline)
+        except Exception as e:
+            # one broken representation must not take down the others or the manifest refresh
+            self.error('Cannot handle %s: %s' % (rep_addr, e))
+            return []
+
+    def write_output_mpd(self, mpd, content=None):
         self.info('Writing the update MPD file')
-        content = xml.etree.ElementTree.tostring(mpd, encoding="utf-8").decode("utf-8")
         dest = os.path.join(self.output_dir, 'manifest.mpd')
         os.makedirs(self.output_dir, exist_ok=True)
 
-        with open(dest, 'wt') as f:
-            f.write(content)
+        with open(dest, 'wb') as f:
+            if content is not None:
+                f.write(content)
+            else:
+                # serialise straight into the file, no intermediate bytes/str copies
+                mpd.getroottree().write(f, encoding="utf-8", xml_declaration=True)
 
         if self.save_mpds:
-            dest = os.path.join(self.output_dir, 'manifest.{}.mpd'.format(self.i_refresh))
-            with open(dest, 'wt') as f:
-                f.write(content)
+            shutil.copyfile(dest, os.path.join(self.output_dir, 'manifest.{}.mpd'.format(self.i_refresh)))
 
 
 class DashDownloader(HasLogger):
+    # same policy as the urllib3 Retry used with requests: 15 attempts, 0.1s exponential backoff capped at 120s
+    retry_statuses = (429, 500, 502, 503, 504)
+    max_attempts = 15
+    retry_backoff = 0.1
+    max_retry_backoff = 120
+
     def __init__(self, proxy, rep_addr):
         self.logger = logger
         self.proxy = proxy
         self.rep_addr = rep_addr
         self.mpd_base_url = ''
 
-        self.initialization_downloaded = False
+        # destination paths already on disk (or being downloaded) and the directories they were looked up in
+        self.existing = set()
+        self.scanned_dirs = set()
+        # prepended to every destination path, so it is joined only once
+        self.dest_prefix = escape_format(os.path.join(proxy.output_dir, ''))
 
-        self.requests = requests.Session()
-        retries = Retry(total=15, backoff_factor=0.1, status_forcelist=[429, 500, 502, 503, 504])
-        self.requests.mount('https://', HTTPAdapter(max_retries=retries))
+        self.client = proxy.client
 
-    def handle_mpd(self, mpd, base_url):
+    def handle_mpd(self, locator, base_url, rep, segment_template, segment_timeline):
         self.mpd_base_url = base_url
-        self.mpd = MpdLocator(mpd)
+        self.mpd = locator
 
-        rep = self.mpd.representation(self.rep_addr)
-        segment_template = self.mpd.segment_template(self.rep_addr)
-        segment_timeline = self.mpd.segment_timeline(self.rep_addr)
+        # (url, dest, info) for each file to fetch
+        tasks = []
 
         initialization_template = segment_template.attrib.get('initialization', '')
-        if initialization_template and not self.initialization_downloaded:
-            self.initialization_downloaded = True
-            self.download_template(initialization_template, rep)
+        if initialization_template:
+            self.add_task(tasks, self.prepare_template(initialization_template, rep), '')
 
-        if segment_timeline:
-            segments = copy.deepcopy(segment_timeline.findall('mpd:S', ns))
+        if segment_timeline is not None:
+            segments = [(int(S.attrib.get('t', '-1')), int(S.attrib.get('d', '0')), int(S.attrib.get('r', '0')))
+                        for S in segment_timeline.iterchildren(TAG_S)]
         else:
-            # Let's create artificial <SegmentTimeline> with a single <S> to keep further processing unified.
+            # Let's create an artificial (t, d, r) of <S> to keep further processing unified.
             d = int(segment_template.attrib.get('duration','0'))
             PSwc = self.mpd.period_start(self.rep_addr)
             PEwc = self.mpd.period_end(self.rep_addr)
@@ -329,88 +449,104 @@ class DashDownloader(HasLogger):
             # - NS=1, (so we create 1-element array here)
             # - ts the value of the @timescale attribute
             ts = int(segment_template.attrib.get('timescale','1'))
-            S = xml.etree.ElementTree.Element('{urn:mpeg:dash:schema:mpd:2011}S', attrib={
+            # r[s] is the ceil of (PEwc[i] - PSwc[i] - t[s]/ts)*ts/d[s]) - 1
+            #                                          ^^^^^^^ this bit can be ignored because t[s] is 0
+            count = math.ceil((PEwc - PSwc) * ts / d)
+            # an empty (or inverted) Period has no segments at all
+            segments = [(
                 # t[s] is 0
-                't':'0',
+                0,
                 # the d[s] is the value of @duration attribute
-                'd': str(d),
-                # r[s] is the ceil of (PEwc[i] - PSwc[i] - t[s]/ts)*ts/d[s])
-                #                                          ^^^^^^^ this bit can be ignored because t[s] is 0
-                'r': str(math.ceil((PEwc - PSwc) * ts / d))
-            })
-            # self.verbose("There is no timeline, created artificial one: <S %s>" % (" ".join([f'{k}="{v}"' for k,v in S.attrib.items()])))
-            segments = [S]
-            # new empty <SegmentTimeline> needed below
-            segment_timeline = xml.etree.ElementTree.Element('{urn:mpeg:dash:schema:mpd:2011}SegmentTimeline')
-
-        idx = 0
-        total=0
-        for segment in segments:
-            duration = int( segment.attrib.get('d', '0') )
-            repeat = int( segment.attrib.get('r', '0') )
-            idx = idx + 1
-            total += duration * (repeat + 1)
-            for _ in range(0, repeat):
-                elem = xml.etree.ElementTree.Element('{urn:mpeg:dash:schema:mpd:2011}S', attrib={'d':str(duration)})
-                segment_timeline.insert(idx, elem)
-                self.verbose('appending a new elem')
-                idx = idx + 1
-
-        media_template = segment_template.attrib.get('media', '')
+                d,
+                count - 1
+            )] if count > 0 else []
+
+        segments, total = expand_segment_timeline(segments)
+
+        media_template = self.prepare_template(segment_template.attrib.get('media', ''), rep)
         timescale = int(segment_template.attrib.get('timescale','1'))
         startNumber = int(segment_template.attrib.get('startNumber','0'))
-        next_time = 0
         total_info = '/' + str(timedelta(seconds=round(total / timescale))) + ' '
-        for index, segment in enumerate(segment_timeline.findall('mpd:S', ns)):
-            current_time = int(segment.attrib.get('t', '-1'))
-            if current_time == -1:
-                segment.attrib['t'] = str(next_time)
-            else:
-                next_time = current_time
-            next_time += int(segment.attrib.get('d', '0'))
-            self.download_template(media_template, rep, segment, info=str(timedelta(seconds=round(next_time / timescale))) + total_info, index=index + startNumber)
-
-    def download_template(self, template, representation=None, segment=None, info='', index=None):
-        dest = self.render_template(template, representation, segment, index)
-        dest_url = self.full_url(dest)
-        dest = dest.split('?')[0]
-        dest = os.path.join(self.proxy.output_dir, dest)
-        if os.path.isfile(dest):
+        skipped = 0
+        for index, (seg_time, duration) in enumerate(segments):
+            info = str(timedelta(seconds=round((seg_time + duration) / timescale))) + total_info
+            if not self.add_task(tasks, media_template, info, number=index + startNumber, seg_time=seg_time):
+                skipped += 1
+        if skipped:
+            self.verbose('%s: skipping %d segments already downloaded' % (self.rep_addr, skipped))
+
+        executor = self.proxy.executor
+        return [executor.submit(self.download, *task) for task in tasks]
+
+    def add_task(self, tasks, template, info, number=None, seg_time=None):
+        url_template, dest_template, dest_dir = template
+        dest = dest_template.format(number=number, time=seg_time)
+        if dest_dir is None:
+            self.scan_dir(os.path.dirname(dest))
+        if dest in self.existing:
+            return False
+        # claimed right away so that the next refresh doesn't queue it again
+        self.existing.add(dest)
+        tasks.append((url_template.format(number=number, time=seg_time), dest, info))
+        return True
+
+    def scan_dir(self, directory):
+        if directory not in self.scanned_dirs:
+            # one directory listing instead of a stat() per segment
+            os.makedirs(directory, exist_ok=True)
+            self.existing.update(entry.path for entry in os.scandir(directory))
+            self.scanned_dirs.add(directory)
+
+    def download(self, dest_url, dest, info=''):
+        self.info('%srequesting %s from %s' % (info, dest, dest_url))
+        created = False
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                with self.client.stream('GET', dest_url) as r:
+                    if r.status_code not in self.retry_statuses or attempt == self.max_attempts:
+                        r.raise_for_status()
+                        if r.status_code >= 200 and r.status_code < 300:
+                            with open(dest, 'xb', buffering=COPY_BUFFER_SIZE) as f:
+                                created = True
+                                for chunk in r.iter_bytes(COPY_BUFFER_SIZE):
+                                    f.write(chunk)
+                        else:
+                            self.error('cannot download %s server returned %d' % (dest_url, r.status_code))
+                            self.existing.discard(dest)
+                        return
+                retry_after = min(self.retry_backoff * 2 ** (attempt - 1), self.max_retry_backoff)
+                self.verbose('%s server returned %d. Retrying after %.1fs' % (dest_url, r.status_code, retry_after))
+                # sleep outside of the with block so that the connection goes back to the pool
+                time.sleep(retry_after)
+        except FileExistsError:
+            # appeared after the directory was scanned, keep it claimed so that it is not queued again
             self.verbose('%sskipping %s already exists' % (info, dest))
-        else:
-            os.makedirs(os.path.dirname(dest), exist_ok=True)
-            self.info('%srequesting %s from %s' % (info, dest, dest_url))
-            try:
-                with self.requests.get(dest_url, stream=True) as r:
-                    r.raise_for_status()
-                    if r.status_code >= 200 and r.status_code < 300:
-                        with open(dest, 'xb') as f:
-                            for chunk in r.iter_content(chunk_size=8196): 
-                                f.write(chunk)
-                    else:
-                        self.error('cannot download %s server returned %d' % (dest_url, r.status_code))
-            except Exception as e:
-                self.error(e)
-
-    def render_template(self, template, representation=None, segment=None, index=None):
-        template = template.replace('$RepresentationID$', '{representation_id}')
+        except Exception as e:
+            self.error(e)
+            # don't leave a truncated segment behind and let the next refresh try again
+            if created:
+                os.remove(dest)
+            self.existing.discard(dest)
+
+    # Turn $...$ identifiers into str.format() templates of the URL and of the destination path once per
+    # representation, so that each segment only needs template.format(number=..., time=...)
+    # Also returns the destination directory unless it depends on the segment.
+    def prepare_template(self, template, representation):
+        template = escape_format(template)
+        template = template.replace('$RepresentationID$', escape_format(representation.attrib.get('id', '')))
         template = template.replace('$Number$', '{number}')
-        template = re.sub('\$Number%([0-9]*)d\$', '{number:\\1d}', template)
+        template = _NUMBER_FMT_RE.sub('{number:\\1d}', template)
         template = template.replace('$Time$', '{time}')
 
-        args = {}
-        if representation is not None:
-            args['representation_id'] = representation.attrib.get('id', '')
-        if segment is not None:
-            args['time'] = segment.attrib.get('t', '')
-        if index is not None:
-            args['number'] = index
-
-        template = template.format(**args)
-        return template
-
-    def full_url(self, dest):
-        return self.mpd_base_url + dest # TODO remove hardcoded arrd
+        url_template = escape_format(self.mpd_base_url) + template
+        dest_template = self.dest_prefix + template.split('?')[0]
+        dest_dir = os.path.dirname(dest_template)
+        if '{' in dest_dir.replace('{{', ''):
+            dest_dir = None
+        else:
+            dest_dir = dest_dir.format()
+            self.scan_dir(dest_dir)
+        return url_template, dest_template, dest_dir
 
 def run(args):
     logger.setLevel(logging.VERBOSE if args.v else logging.INFO)